@@ -1,6 +1,16 @@
 from numpy import *
-from scipy.optimize import nnls
+from scipy.fft import rfftn, irfftn
+from numba import njit, prange
+import numpy
 import math
+import warnings
+
+try:
+    import cupy
+    import cupyx.scipy.fft as cupy_fft
+except ImportError:
+    # cupy is only needed for use_gpu=True
+    cupy = None
 
 '''
 
@@ -24,8 +34,11 @@ def elmm_admm( data, A_init, psis_init, S0, lambda_s, lambda_a, lambda_psi, **kw
     -data: m*n*L image cube, where m is the number of rows, n the number of
     columns, and L the number of spectral bands.
     -A_init: P*N initial abundance matrix, with P the number of endmembers
-    to consider, and N the number of pixels (N=m*n)
-    -psis_init: P*N initial scaling factor matrix
+    to consider, and N the number of pixels (N=m*n). Pixels are in
+    column-major order, as in MATLAB: column k = i + j*m is the pixel at
+    row i and column j of the image
+    -psis_init: P*N initial scaling factor matrix, pixels in the same order
+    as A_init
     -S0: L*P reference endmember matrix
     -lambda_s: regularization parameter on the ELMM tightness
     -lambda_a: regularization parameter for the spatial regularization on
@@ -59,13 +72,22 @@ def elmm_admm( data, A_init, psis_init, S0, lambda_s, lambda_a, lambda_psi, **kw
     dual residuals (default: 10^(-2))
     -epsilon_admm_rel: tolerance on the relative part of the primal and
     dual residuals (default: 10^(-2))
+    -dtype: floating point type of the computations; single precision is
+    enough for the noise level of hyperspectral data and halves the memory
+    traffic, use float64 for ill-conditioned data (default: float32)
+    -use_gpu: run the whole algorithm on the GPU with cupy; the inputs are
+    transferred once and the outputs copied back at the end (default: false)
 
-   Outputs:
+   Outputs (pixels in the column-major order of A_init, k = i + j*m):
     -A: P*N abundance matrix
     -psi_maps: P*N scaling factor matrix
-    -S: L*P*N tensor constaining all the endmember matrices for each pixel
-    -optim_struct: structure containing the values of the objective
-    function and its different terms at each iteration
+    -S: N*L*P tensor constaining all the endmember matrices for each pixel
+    (S[k] is the L*P endmember matrix of pixel k)
+    -optim_struct: dict containing the values of the objective
+    function and its different terms at each iteration ('obj', 'fit',
+    'regul', 'TVa', 'smoothpsi', as in MATLAB), and the primal and dual
+    residuals of each ADMM iteration of each ANLS iteration ('primal',
+    'dual', maxiter_anls*maxiter_admm)
     '''
  
     # set default values for optional parameters
@@ -78,99 +100,150 @@ def elmm_admm( data, A_init, psis_init, S0, lambda_s, lambda_a, lambda_psi, **kw
     epsilon_psi = kwargs.get('epsilon_psi', 10**(-3))
     epsilon_admm_abs = kwargs.get('epsilon_admm_abs', 10**(-2))
     epsilon_admm_rel = kwargs.get('epsilon_admm_rel', 10**(-2))
+    dtype = kwargs.get('dtype', float32)
+    use_gpu = kwargs.get('use_gpu', False)
+
+    if use_gpu and cupy is None:
+        raise ImportError('use_gpu requires cupy')
+
+    # array module of the chosen backend: the numpy functions used below
+    # dispatch to cupy for GPU arrays, only array creation needs xp
+    xp = cupy if use_gpu else numpy
+
+    # work on contiguous arrays of the requested precision, on the device
+    data = xp.asarray(data, dtype=dtype, order='C')
+    A_init = xp.asarray(A_init, dtype=dtype, order='C')
+    psis_init = xp.asarray(psis_init, dtype=dtype, order='C')
+    S0 = xp.asarray(S0, dtype=dtype, order='C')
+    lambda_s = numpy.dtype(dtype).type(lambda_s)
+    lambda_a = atleast_2d(xp.asarray(lambda_a, dtype=dtype))
+    lambda_psi = atleast_2d(xp.asarray(lambda_psi, dtype=dtype))
 
 
     P = A_init.shape[0]  # number of endmembers
 
+    # as MATLAB's length(): one element is a scalar, P elements (a row, a
+    # column or a 1-D array) a vector, stored as a P*1 column
     scalar_lambda_a = False
     scalar_lambda_psi = False
     
-    if lambda_a.shape[1] == 1:
+    if lambda_a.size == 1:
         scalar_lambda_a = True
-    elif lambda_a.shape[1] == P:
-        
-        if lambda_a.shape[0] == 1:
-            lambda_a = lamdba_a.transpose()
+        lambda_a = lambda_a.reshape((1,1))
+    elif lambda_a.size == P:
+        lambda_a = lambda_a.reshape((P,1))
     else:
         raise ValueError('lambda_a must be a scalar or a P-dimensional vector')
 
-    if lambda_psi.shape[1] == 1:
+    if lambda_psi.size == 1:
         scalar_lambda_psi = True
-    elif lambda_psi.shape[1] == P:
-        if lambda_psi.shape[0] == 1:
-            lambda_psi = lamdba_psi.transpose()
+        lambda_psi = lambda_psi.reshape((1,1))
+    elif lambda_psi.size == P:
+        lambda_psi = lambda_psi.reshape((P,1))
     else:
         raise ValueError('lambda_psi must be a scalar or a P-dimensional vector')
 
+    # shrinkage step of the ADMM loop (min w.r.t. v2 and v3), selected once
+    # for the lambda_a shape and the norm so the loop does not branch on them
+    if norm_sr not in ('1,1', '2,1'):
+        raise ValueError("norm_sr must be '1,1' or '2,1'")
+    admm_shrink = {(True, '1,1'): admm_scalar_11,
+                   (True, '2,1'): admm_scalar_21,
+                   (False, '1,1'): admm_vec_11,
+                   (False, '2,1'): admm_vec_21}[(scalar_lambda_a, norm_sr)]
+
 
     m, n, L = data.shape
     N = m*n
 
-    # data_r = data.reshape((N, L)).transpose()
-    data_r = data.copy().reshape((N, L) ,order='F').conj().T
+    # pixels are ordered column by column (k = i + j*m), as MATLAB's reshape
+    # does; conv2im/conv2mat and ConvC use the same order
+    data_r = data.reshape((N, L), order='F').T
    
-    rs = zeros((maxiter_anls,1))
-    ra = zeros((maxiter_anls,1))
-    rpsi = zeros((maxiter_anls,1))
+    rs = xp.zeros((maxiter_anls,1))
+    ra = xp.zeros((maxiter_anls,1))
+    rpsi = xp.zeros((maxiter_anls,1))
 
     A = A_init
     # MATLAB: S = repmat(S0,[1,1,N]);
-    S = array([tile(S0,(1,1)) for i in range(N)]).T
+    # stored pixel-major (N*L*P) so that each S[k] is contiguous and stacked
+    # products go through matmul
+    # all pixels start from S0: S begins as a read-only broadcast view, the
+    # N*L*P arrays are only allocated by the S-updates
+    S = broadcast_to(S0, (N,L,P))
+    S_spare = None
     
     psi_maps = psis_init
 
-    S0ptS0 = diag(S0.T@S0)
-    S0ptS0 = S0ptS0[None,].T
+    # diagonal of S0'*S0, as a P*1 column
+    S0ptS0 = (S0*S0).sum(axis=0)[:,None]
 
-    objective = zeros((maxiter_anls,1))
-    norm_fitting = zeros((maxiter_anls,1))
-    source_model = zeros((maxiter_anls,1))
+    objective = xp.zeros((maxiter_anls,1))
+    norm_fitting = xp.zeros((maxiter_anls,1))
+    source_model = xp.zeros((maxiter_anls,1))
     
     if scalar_lambda_a:
-        TV_a = zeros((maxiter_anls,1))
+        TV_a = xp.zeros((maxiter_anls,1))
     else:
-        TV_a = zeros((maxiter_anls,P))
+        TV_a = xp.zeros((maxiter_anls,P))
 
     if scalar_lambda_psi:
-        smooth_psi = zeros((maxiter_anls,1))
+        smooth_psi = xp.zeros((maxiter_anls,1))
     else:
-        smooth_psi = zeros((maxiter_anls,P))
+        smooth_psi = xp.zeros((maxiter_anls,P))
 
     # forward first order horizontal difference operator
-    FDh = zeros((m,n))
-    FDh[0, n-1] = -1
+    # all the data handled in the Fourier domain is real, so the operators
+    # (and everything derived from them) are kept as m*(n//2+1) half spectra
+    FDh = xp.zeros((m,n), dtype=dtype)
+    FDh[m-1, 0] = -1
     FDh[m-1,n-1] = 1
-    FDh = fft.fft2(FDh)
+    FDh = rfft_im(FDh)
     FDhC = conj(FDh)
 
     # forward first order vertical  difference operator
-    FDv = zeros((m,n))
+    FDv = xp.zeros((m,n), dtype=dtype)
     FDv[0, n-1] = -1
-    FDv[m-1,n-1] = 1;
-    FDv = fft.fft2(FDh)
-    FDvC = conj(FDh)
+    FDv[m-1,n-1] = 1
+    FDv = rfft_im(FDv)
+    FDvC = conj(FDv)
+
+    # loop invariant spectral terms of the v1 and psi updates
+    FDh_abs2 = abs(FDh)**2
+    FDv_abs2 = abs(FDv)**2
+    Kabs = FDh_abs2 + FDv_abs2
+    denom_fft = 1.0 + Kabs
 
     # barrier parameter of ADMM and related
-    rho = zeros((maxiter_admm,1))
+    rho = empty(maxiter_admm, dtype=dtype)
     rho[0] = 10
     tau_incr = 2
     tau_decr = 2
     nu = 10
 
+    # primal and dual residuals of each ADMM iteration, for each ANLS iteration
+    primal_all = zeros((maxiter_anls,maxiter_admm))
+    dual_all = zeros_like(primal_all)
+
 
-    # EXPECTED BUG: matrix vs element multiplication
     for i in range(maxiter_anls):
-        S_old = S.copy()
-        psi_maps_old = psi_maps.copy()
-        A_old_anls = A.copy()
+        # S, A and psi_maps are rebound by their updates, never modified in
+        # place, so the previous iterates are kept without copying. The new S
+        # is written into the buffer of the S before last (a new one is
+        # allocated during the first two iterations).
+        S_old = S
+        psi_maps_old = psi_maps
+        A_old_anls = A
         
         
         #S_update
-        for k in range(N):
-            first_op = data_r[:,k]@A[:,k].conj().T+(lambda_s*S0)@diag(psi_maps[:,k])
-            second_op = A[:,k]@A[:,k].conj().T+lambda_s*eye(P)
-            S[:,:,k] = dot(first_op, linalg.pinv(second_op))  # first_op / second_op
-            S[:,:,k] = maximum(pow(10,-6), S[:,:,k])
+        # all N pixels at once: S_k = (y_k a_k' + lambda_s*S0*diag(psi_k)) / (a_k a_k' + lambda_s*I)
+        # (S0*diag(psi_k) scales the columns of S0 by psi_k)
+        numerator = einsum('lk,pk->klp', data_r, A) + lambda_s*S0[None,:,:]*psi_maps.T[:,None,:]
+        denominator = einsum('pk,qk->kpq', A, A) + lambda_s*xp.eye(P, dtype=dtype)
+        # right division by the (symmetric) denominator, solved as a stack of P*P systems
+        S = maximum(1e-6, linalg.solve(denominator, numerator.transpose(0,2,1)).transpose(0,2,1), out=S_spare)
+        S_spare = S_old if i > 0 else None
 
 
         # A_update
@@ -184,47 +257,41 @@ def elmm_admm( data, A_init, psis_init, S0, lambda_s, lambda_a, lambda_psi, **kw
             v4 = A
 
             # initialize Lagrange multipliers
-            d1 = zeros((P,N))
-            d2 = zeros((v2.shape))
-            d3 = zeros((v3.shape))
-            d4 = zeros((psi_maps.shape))
+            d1 = xp.zeros((P,N), dtype=dtype)
+            d2 = xp.zeros(v2.shape, dtype=dtype)
+            d3 = xp.zeros(v3.shape, dtype=dtype)
+            d4 = xp.zeros(psi_maps.shape, dtype=dtype)
 
-            mu = zeros((1,N))
+            mu = xp.zeros(N, dtype=dtype)
 
-            # initialize primal and dual variables
-            primal = zeros((maxiter_admm,1))
-            dual = zeros((maxiter_admm,1))
+            # primal and dual residuals of this ADMM loop
+            primal = primal_all[i]
+            dual = dual_all[i]
 
             # precomputing
+            # S is fixed during the ADMM loop, so are the per-pixel Gram matrices and S'y
+            StS = S.transpose(0,2,1) @ S
+            Std = einsum('klp,lk->kp', S, data_r)
             Hvv1 = ConvC(v1,FDv,m,n,P)
             Hhv1 = ConvC(v1,FDh,m,n,P)
 
+            # squared norms of p_res2 and p_res3, carried over to the next iteration
+            p_res2 = v2 - Hhv1
+            p_res3 = v3 - Hvv1
+            n2 = einsum('ij,ij->', p_res2, p_res2)
+            n3 = einsum('ij,ij->', p_res3, p_res3)
+
             for j in range(maxiter_admm):
-                A_old = A
+                A_old = A  # A is rebound below, not updated in place
                 v1_old = v1
-                p_res2_old = v2 - Hhv1;
-                p_res3_old = v3 - Hvv1
                 v4_old = v4
-                d1_old = d1
-                d4_old = d4
-
-                for k in range(N):
-                    ALPHA = S[:,:,k].T@S[:,:,k]+2*rho[j]*eye(P)
-                    ALPHA_INVERTED = linalg.inv(ALPHA)
-                    BETA = ones((P,1))
-                    s = ALPHA_INVERTED.sum(axis=0)
-                    SEC_MEMBER = concatenate(( S[:,:,k].T@data_r[:,k] + rho[j]*(v1[:,k] + d1[:,k] + v4[:,k] + d4[:,k]), array([1])), axis=0)
-                    OMEGA_a = concatenate((ALPHA_INVERTED@(eye(P)-1/s*ones((P,P))@ALPHA_INVERTED), 1/s * ALPHA_INVERTED * BETA), axis=None)
-                    OMEGA_b = concatenate( (1/s*BETA.T*ALPHA_INVERTED, -1/s), axis=None)
-                    print(OMEGA_a.shape)
-                    print(OMEGA_b.shape)
-                    OMEGA_INV = concatenate(( OMEGA_a, OMEGA_b), axis=0)
-                    print(OMEGA_INV.shape)
-                    print(SEC_MEMBER.shape)
-                    X = OMEGA_INV @ SEC_MEMBER
-
-                    A[:,k] = X[0:-2]
-                    mu[k] = X[-1]
+                # the multipliers are updated in place, only their norms are kept
+                n2_old, n3_old = n2, n3
+                nd1_old = einsum('ij,ij->', d1, d1)
+                nd4_old = einsum('ij,ij->', d4, d4)
+
+                # min w.r.t. A and mu: one (P+1)*(P+1) KKT system per pixel
+                A, mu = admm_kkt_solve(StS, Std, v1, d1, v4, d4, rho[j])
 
                 A_im = conv2im(A,m,n,P)
                 d1_im = conv2im(d1,m,n,P)
@@ -235,66 +302,41 @@ def elmm_admm( data, A_init, psis_init, S0, lambda_s, lambda_a, lambda_psi, **kw
 
                 # update in the Fourier domain
 
-                for p in range(P):
-                    sec_spectral_term = fft.fft2(squeeze(A_im[:,:,p]) - squeeze(d1_im[:,:,p])) + fft.fft2(squeeze((v2_im[:,:,p]+squeeze(d2_im[:,:,p])))*FDhC + fft.fft2(squeeze(v3_im[:,:,p]+squeeze(d3_im[:,:,p]))))*FDvC
-                    v1_im[:,:,p] = dot(real(ftt.ifft2((sec_spectral_term), linalg.pinv(ones((m,n)) + abs(FDh)**2 + abs(FDv)**2))))
+                # all P planes of the m*n*P cube are transformed at once
+                sec_spectral_term = rfft_im(A_im - d1_im) + rfft_im(v2_im + d2_im)*FDhC[:,:,None] + rfft_im(v3_im + d3_im)*FDvC[:,:,None]
+                v1_im = irfft_im(sec_spectral_term/denom_fft[:,:,None], m, n)
 
 
                 # convert back necessary variables into matrices
 
-                v1 = conv2mat(v1_im)
-                Hvv1 = ConvC(v1,FDv)
-                Hhv1 = ConvC(v1, FDh)
+                v1 = conv2mat(v1_im,m,n,P)
+                Hvv1 = ConvC(v1,FDv,m,n,P)
+                Hhv1 = ConvC(v1,FDh,m,n,P)
 
 
                 # min w.r.t. v2 and v3
 
-                if scalar_lambda_a:
-                    if norm_sr == '2,1':
-                        v2 = vector_soft_col( -(d2-Hhv1), lambda_a/rho[j])
-                        v3 = vector_soft_col( -(d3-Hvv1), lambda_a/rho[j])
-                    elif norm_sr == '1,1':
-                        v2 = soft( -(d2-Hhv1), lambda_a/rho[j])
-                        v3 = soft( -(d3-Hvv1), lambda_a/rho[j])
-                else:
-                    if norm_sr == '2,1':
-                        for p in range(P):
-                            v2[p,:] = vector_soft_col(-(d2[p,:] - Hhv1[p,:]), lambda_a[p]/rho[j])
-                            v3[p,:] = vector_soft_col(-(d3[p,:] - Hvv1[p,:]), lambda_a[p]/rho[j])
-                    elif norm_sr == '1,1':
-                            v2[p,:] = soft(-(d2[p,:] - Hhv1[p,:]), lambda_a[p]/rho[j])
-                            v3[p,:] = soft(-(d3[p,:] - Hvv1[p,:]), lambda_a[p]/rho[j])
-
-                            
-                # min w.r.t. v4
-
-                v4 = max(A-d4, zeros(A.shape))
-
-
-                # dual update
-                # compute necessary variables for the residuals and update lagrange multipliers
-                p_res1 = v1 - A;
-                p_res2 = v2 - Hhv1;
-                p_res3 = v3 - Hvv1;
-                p_res4 = v4 - A;
-                
-                d1 = d1 + p_res1;
-                d2 = d2 + p_res2;
-                d3 = d3 + p_res3;
-                d4 = d4 + p_res4;
+                v2, v3 = admm_shrink(d2, d3, Hhv1, Hvv1, lambda_a, rho[j])
+
+                # min w.r.t. v4 and dual update
+                # v4, the residuals and the (in place) update of the lagrange
+                # multipliers are computed in a single pass
+
+                v4, n1, n2, n3, n4, ndv1, ndv4 = admm_dual_update(A, v1, v1_old, v2, v3, v4_old, d1, d2, d3, d4, Hhv1, Hvv1)
 
 
                 # primal and dual residuals
 
-                primal[j] = math.sqrt( linalg.norm(p_res1, 'fro')**2 + linalg.norm(p_res2, 'fro')**2 + linalg.norm(p_res3, 'fro')**2 + linalg.norm(p_res4, 'fro')**2 )
-                dual[j] = rho[j] * math.sqrt( linalg.norm(v1_old-v1,'fro')**2 + linalg.norm(v4_old-v4,'fro')**2 )
+                primal[j] = math.sqrt(n1 + n2 + n3 + n4)
+                dual[j] = rho[j] * math.sqrt(ndv1 + ndv4)
 
                 # compute termination values
 
-                epsilon_primal = math.sqrt(4*P*N) * epsilon_admm_abs + epsilon_admm_rel*max(math.sqrt(2*linalg.norm(A,'fro')**2), math.sqrt(linalg.norm(v1_old,'fro')**2 + linalg.norm(p_res2_old,'fro')**2 + linalg.norm(p_res3_old,'fro')**2 + linalg.norm(v4_old,'fro')**2))
-                epsilon_dual = math.sqrt(P*N)*epsilon_admm_abs + rho[j] * epsilon_admm_rel * math.sqrt(linalg.norm(d1_old,'fro')+linalg.norm(d4_old,'fro')**2)
+                epsilon_primal = math.sqrt(4*P*N) * epsilon_admm_abs + epsilon_admm_rel*maximum(math.sqrt(2*einsum('ij,ij->', A, A)), math.sqrt(einsum('ij,ij->', v1_old, v1_old) + n2_old + n3_old + einsum('ij,ij->', v4_old, v4_old)))
+                epsilon_dual = math.sqrt(P*N)*epsilon_admm_abs + rho[j] * epsilon_admm_rel * math.sqrt(math.sqrt(nd1_old) + nd4_old)
 
-                rel_A = dot(abs(linalg.norm(A,'fro')-linalg.norm(A_old,'fro')), linalg.pinv(linalg.norm(A_old,'fro')))
+                norm_A_old = linalg.norm(A_old)
+                rel_A = abs(linalg.norm(A) - norm_A_old)/norm_A_old
 
 
                 # display of admm results
@@ -302,17 +344,17 @@ def elmm_admm( data, A_init, psis_init, S0, lambda_s, lambda_a, lambda_psi, **kw
                 if verbose:
                     print(f'iter {j}, rel_A = {rel_A}, primal = {primal[j]}, eps_p = {epsilon_primal}, dual = {dual[j]}, eps_d = {epsilon_dual}, rho = {rho[j]}')
 
-                if j > 1 and ((primal[j] < epsilon_primal and dual[j] < epsilon_dual)):
+                if j > 0 and ((primal[j] < epsilon_primal and dual[j] < epsilon_dual)):
                     break
 
 
                 # rho update
 
-                if j < maxiter_admm:
-                    if norm(primal[j]) > nu*norm(dual[j]):
+                if j < maxiter_admm-1:
+                    if primal[j] > nu*dual[j]:
                         rho[j+1] = tau_incr*rho[j]
                         A = A/tau_incr
-                    elif norm(dual[j]) < nu*norm(primal[j]):
+                    elif dual[j] > nu*primal[j]:
                         rho[j+1] = rho[j]/tau_decr
                         A = tau_decr * A
                     else:
@@ -322,131 +364,108 @@ def elmm_admm( data, A_init, psis_init, S0, lambda_s, lambda_a, lambda_psi, **kw
 
         else:
             # without spatial regularization
-            for k in range(N):
-                A[:,k] = FCLSU(data_r[:,k],S[:,:,k])
-
-            if verbose:
-                print("Done")
-                print("updating psi..")
-
-            # psi_update
-
-            if any(lambda_psi):
-                # with spatial regularization
-                if scalar_lambda_psi:
-                    for p in range(P):
-                        numerator = 0 # TODO
-                        psi_maps_im = real(fft.ifft2(fft.fft2(numerator)/((lambda_psi*(abs(FDh)**2+abs(FDv)**2)+lambda_s*S0ptS0[p]))))
-                        psi_maps[p,:] = psi_maps_im[:]
-
-                else:
-                    for p in range(P):
-                        numerator = 0 # TODO (translate from matlab)
-                        psi_maps_im = real(fft.ifft2(fft.fft2(numerator)/((lambda_psi[p]*(abs(FDh)**2+abs(FDv)**2)+lambda_s*S0ptS0[p]))))
-                        psi_maps[p,:] = psi_maps_im[:]
-            else:
-                for p in range(P):
-                    psi_maps_temp = zeros((N,1))
-                    for k in range(N):
-                        psi_maps_temp[k] = (S0[:,p].T@S[:,p,k])/S0ptS0[p]
-                        
-                    psi_maps[p,:] = psi_maps_temp.flatten()
+            A = FCLSU(data_r,S).T
 
-            if verbose:
-                print("Done")
+        if verbose:
+            print("Done")
+            print("updating psi..")
 
-                
-            # residuals of the ANLS loops
-            rs_vect = zeros((N,1))
+        # psi_update
 
-            for k in range(N):
-                rs_vect[k] = linalg.norm(squeeze(S[:,:,k])-squeeze(S_old[:,:,k]),'fro')/linalg.norm(squeeze(S_old[:,:,k]),'fro')
+        if any(lambda_psi):
+            # with spatial regularization, all P maps solved at once in the Fourier domain
+            numerator = conv2im(lambda_s*einsum('klp,lp->pk', S, S0),m,n,P)
+            psi_maps_im = irfft_im(rfft_im(numerator)/(lambda_psi.ravel()*Kabs[:,:,None] + lambda_s*S0ptS0.ravel()), m, n)
+            psi_maps = conv2mat(psi_maps_im,m,n,P)
+        else:
+            psi_maps = einsum('klp,lp->pk', S, S0)/S0ptS0
 
-            rs[i] = rs_vect.mean(axis=0)
-            ra[i] = linalg.norm(A[:]-A_old_anls[:],2)/linalg.norm(A_old_anls[:],2)
-            rpsi[i] = linalg.norm(psi_maps-psi_maps_old,'fro')/(linalg.norm(psi_maps_old,'fro'))
+        if verbose:
+            print("Done")
 
-            # compute objective function value
+            
+        # residuals of the ANLS loops
+        # (relative variation of each pixel's endmember matrix, averaged)
+        rs_vect = linalg.norm(S - S_old, axis=(1,2)) / maximum(linalg.norm(S_old, axis=(1,2)), 1e-30)
 
-            SkAk = zeros((L,N))
-            S0_psi = ndarray((L,P,N))  # S0_psi initializes automatically in matlab in forloop, manually here
-            for k in range(N):
-                SkAk[:,k] = squeeze(S[:,:,k]@A[:,k])
-                S0_psi[:,:,k] = S0*diag(psi_maps[:,k])
+        rs[i] = rs_vect.mean()
+        ra[i] = linalg.norm(A - A_old_anls)/linalg.norm(A_old_anls)
+        rpsi[i] = linalg.norm(psi_maps-psi_maps_old,'fro')/(linalg.norm(psi_maps_old,'fro'))
 
-            norm_fitting[i] = 1/2*linalg.norm(data_r[:]-SkAk[:])**2
+        # compute objective function value
 
-            source_model[i] = 1/2*linalg.norm(S[:]-S0_psi[:])**2
+        # S0*diag(psi_k) only scales the columns of S0
+        SkAk = einsum('klp,pk->lk', S, A)
+        S0_psi = S0[None,:,:] * psi_maps.T[:,None,:]
 
-            if any(lambda_psi) and any(lambda_a):  # different objective functions depending on the chosen regularizations
-                if scalar_lambda_psi:
-                    smooth_psi[i] = 1/2*(sum(sum((ConvC(psi_maps,FDh,m,n,P)**2))) + sum(sum((ConvC(psi_maps,FDv,m,n,P)**2))))
-                else:
-                    CvCpsih = ConvC(psi_maps,FDh,m,n,P)
-                    CvCpsiv = ConvC(psi_maps,FDv,m,n,P)
-                    for p in range(P):
-                        smooth_psi[i,p] = 1/2*(sum(sum((CvCpsih[p,:h]**2))) + sum(sum((CVCpsiv[p,:]**2))))
+        norm_fitting[i] = 1/2*linalg.norm(data_r - SkAk)**2
 
+        source_model[i] = 1/2*linalg.norm((S - S0_psi).reshape(-1))**2
 
-                if scalar_lambda_a:
-                    if norm_sr == '2,1':
-                        TV_a[i] = sum(sum(math.sqrt(ConvC(A,FDh,m,n,P)**2 + ConvC(A,FDv,m,n,P)**2)))
-                    elif norm_sr == '1,1':
-                        TV_a[i] = sum(sum(abs(ConvC(A,FDh,m,n,P)) + abs(ConvC(A,FDv,m,n,P))))
-                else:
-                    CvCAh = ConvC(A,FDh,m,n,P)
-                    CvCAv = ConvC(A,FDv,m,n,P)
+        if any(lambda_psi) and any(lambda_a):  # different objective functions depending on the chosen regularizations
+            if scalar_lambda_psi:
+                smooth_psi[i] = 1/2*(sum(sum((ConvC(psi_maps,FDh,m,n,P)**2))) + sum(sum((ConvC(psi_maps,FDv,m,n,P)**2))))
+            else:
+                CvCpsih = ConvC(psi_maps,FDh,m,n,P)
+                CvCpsiv = ConvC(psi_maps,FDv,m,n,P)
+                smooth_psi[i,:] = 1/2*((CvCpsih**2).sum(axis=1) + (CvCpsiv**2).sum(axis=1))
 
-                    if norm_sr == '2,1':
-                        for p in range(P):
-                            TV_a[i,p] = sum(sum(math.sqrt(CvCAh[p,:]**2 + CvCAv[p,:]**2)))
-                    elif norm_sr == '1,1':
-                        for p in range(P):
-                            TV_a[i,p] = sum(sum(abs(CvCAh[p,:])+abs(CvCAv[p,h])))
 
-                objective[i] = norm_fitting[i] + lambda_s * source_model[i] + lambda_a.transpose() * TV_a[i,:].transpose() + lambda_psi.transpose * smooth_psi[i,:].transpose()
+            if scalar_lambda_a:
+                if norm_sr == '2,1':
+                    TV_a[i] = hypot(ConvC(A,FDh,m,n,P), ConvC(A,FDv,m,n,P)).sum()
+                elif norm_sr == '1,1':
+                    TV_a[i] = sum(sum(abs(ConvC(A,FDh,m,n,P)) + abs(ConvC(A,FDv,m,n,P))))
+            else:
+                CvCAh = ConvC(A,FDh,m,n,P)
+                CvCAv = ConvC(A,FDv,m,n,P)
 
-            elif not(any(lambda_psi)) and any(lambda_a):
+                if norm_sr == '2,1':
+                    TV_a[i,:] = hypot(CvCAh, CvCAv).sum(axis=1)
+                elif norm_sr == '1,1':
+                    TV_a[i,:] = (abs(CvCAh) + abs(CvCAv)).sum(axis=1)
 
-                if scalar_lambda_a:
-                    if norm_sr == '2,1':
-                        TV_a[i] = sum(sum(math.sqrt(ConvC(A,FDh,m,n,P)**2 + ConvC(A,FDv,m,n,P)**2)))
-                    elif norm_sr == '1,1':
-                        TV_a[i] = sum(sum(abs(ConvC(A,FDh,m,n,P)) + abs(ConvC(A,FDv,m,n,P))))
-                else:
-                    CvCAh = ConvC(A,FDh,m,n,P)
-                    CvCAv = ConvC(A,FDv,m,n,P)
+            objective[i] = norm_fitting[i] + lambda_s * source_model[i] + lambda_a.ravel() @ TV_a[i,:] + lambda_psi.ravel() @ smooth_psi[i,:]
 
-                    if norm_sr == '2,1':
-                        for p in range(P):
-                            TV_a[i,p] = sum(sum(math.sqrt(CvCAh[p,:]**2 + CvCAv[p,:]**2)))
-                    elif norm_sr == '1,1':
-                        for p in range(P):
-                            TV_a[i,p] = sum(sum(abs(CvCAh[p,:])+abs(CvCAv[p,h])))
+        elif not(any(lambda_psi)) and any(lambda_a):
 
+            if scalar_lambda_a:
+                if norm_sr == '2,1':
+                    TV_a[i] = hypot(ConvC(A,FDh,m,n,P), ConvC(A,FDv,m,n,P)).sum()
+                elif norm_sr == '1,1':
+                    TV_a[i] = sum(sum(abs(ConvC(A,FDh,m,n,P)) + abs(ConvC(A,FDv,m,n,P))))
+            else:
+                CvCAh = ConvC(A,FDh,m,n,P)
+                CvCAv = ConvC(A,FDv,m,n,P)
 
-                objective[i] = norm_fitting[i] + lambda_s * source_model[i] + lambda_a.transpose() * TV_a[i,:].transpose()
+                if norm_sr == '2,1':
+                    TV_a[i,:] = hypot(CvCAh, CvCAv).sum(axis=1)
+                elif norm_sr == '1,1':
+                    TV_a[i,:] = (abs(CvCAh) + abs(CvCAv)).sum(axis=1)
 
 
-            elif any(lambda_psi) and not(any(lambda_a)):
-                if scalar_lambda_psi:
-                    smooth_psi[i] = 1/2*(sum(sum((ConvC(psi_maps,FDh,m,n,P)**2))) + sum(sum((ConvC(psi_maps,FDv,m,n,P)**2))))
-                else:
-                    CvCpsih = ConvC(psi_maps,FDh,m,n,P)
-                    CvCpsiv = ConvC(psi_maps,FDv,m,n,P)
-                    for p in range(P):
-                        smooth_psi[i,p] = 1/2*(sum(sum((CvCpsih[p,:h]**2))) + sum(sum((CVCpsiv[p,:]**2))))
+            objective[i] = norm_fitting[i] + lambda_s * source_model[i] + lambda_a.ravel() @ TV_a[i,:]
 
-                objective[i] = norm_fitting[i] + lambda_s * source_model[i] + lambda_psi.transpose() * smooth_psi[i,:].transpose()
 
+        elif any(lambda_psi) and not(any(lambda_a)):
+            if scalar_lambda_psi:
+                smooth_psi[i] = 1/2*(sum(sum((ConvC(psi_maps,FDh,m,n,P)**2))) + sum(sum((ConvC(psi_maps,FDv,m,n,P)**2))))
             else:
-                objective[i] = norm_fitting[i] + lambda_s * source_model[i]
+                CvCpsih = ConvC(psi_maps,FDh,m,n,P)
+                CvCpsiv = ConvC(psi_maps,FDv,m,n,P)
+                smooth_psi[i,:] = 1/2*((CvCpsih**2).sum(axis=1) + (CvCpsiv**2).sum(axis=1))
 
-            # termination test
-            print(f'iteration: {i}');
-            if (rs[i] < epsilon_s) and (ra[i] < espilon_a) and (rpsi[i] < epsilon_psi):
-                break
-                            
+            objective[i] = norm_fitting[i] + lambda_s * source_model[i] + lambda_psi.ravel() @ smooth_psi[i,:]
+
+        else:
+            objective[i] = norm_fitting[i] + lambda_s * source_model[i]
+
+        # termination test
+        if verbose:
+            print(f'iteration: {i}')
+        if (rs[i] < epsilon_s) and (ra[i] < epsilon_a) and (rpsi[i] < epsilon_psi):
+            break
+                        
 
 
     # gather processed output
@@ -455,15 +474,30 @@ def elmm_admm( data, A_init, psis_init, S0, lambda_s, lambda_a, lambda_psi, **kw
     Outputs:
     -A: P*N abundance matrix
     -psi_maps: P*N scaling factor matrix
-    -S: L*P*N tensor constaining all the endmember matrices for each pixel
+    -S: N*L*P tensor constaining all the endmember matrices for each pixel
     -optim_struct: structure containing the values of the objective
     function and its different terms at each iteration
     '''
 
+    optim_struct = {'obj': objective,
+                    'fit': norm_fitting,
+                    'regul': source_model,
+                    'TVa': TV_a,
+                    'smoothpsi': smooth_psi}
+
+    if use_gpu:
+        A, psi_maps, S = A.get(), psi_maps.get(), S.get()
+        optim_struct = {key: value.get() for key, value in optim_struct.items()}
+
+    # the ADMM residual histories are kept on the host
+    optim_struct['primal'] = primal_all
+    optim_struct['dual'] = dual_all
+
     outputs = []
     outputs.append(A)
     outputs.append(psi_maps)
     outputs.append(S)
+    outputs.append(optim_struct)
     
 
     return outputs
@@ -475,73 +509,288 @@ def elmm_admm( data, A_init, psis_init, S0, lambda_s, lambda_a, lambda_psi, **kw
 # Fully Constrained Linear Spectral Unmixing
 # has it's own .m file in source code
 # may be useful to implement in it's own file
-def FCLSU(HIM,M):
-    # depends on scipy nnls import
-    # this was a hacky implementation
-    # should be tested
+def FCLSU(HIM, M, maxiter=None):
+    # HIM: l*ns pixels (or a single l-dimensional pixel)
+    # M: l*p endmember matrix shared by all pixels, or ns*l*p stack with
+    # one endmember matrix per pixel
+    # maxiter: cap on the active set iterations (default: 3*p); a
+    # RuntimeWarning is issued if some pixels are still not optimal
+    # returns the ns*p abundances
+    #
+    # The MATLAB version runs lsqnonneg on each pixel, with the sum-to-one
+    # constraint appended as an extra row weighted by 1/Delta. Here all the
+    # pixels go through the same active set iterations together: each
+    # iteration solves, in one batch, the sum-to-one constrained least
+    # squares restricted to the current supports, then either steps back to
+    # the boundary and drops a negative abundance, or adds the endmember
+    # with the most negative multiplier. Pixels leave the batch once their
+    # KKT conditions hold.
 
     if len(HIM.shape) == 1:
         HIM = HIM[:,None]
-       
+
+    xp = get_array_module(HIM)
     ns = HIM.shape[1]
-    l = M.shape[0]
-    p = M.shape[1]
-    Delta = 1/1000
-    N = zeros((l+1,p))
-    N[0:l,0:p] = Delta*M
-    N[l,:] = ones((1,p))
-    s = zeros((l+1,1))
-    
-    out = zeros((ns,p))
+    p = M.shape[-1]
+    if maxiter is None:
+        maxiter = 3*p
+
+    # normal equations of every pixel, stacked as ns*p*p and ns*p
+    if len(M.shape) == 2:
+        MtM = broadcast_to(M.T@M, (ns,p,p))
+        MtY = (M.T@HIM).T
+    else:
+        MtM = M.transpose(0,2,1) @ M
+        MtY = einsum('klp,lk->kp', M, HIM)
+
+    out = xp.full((ns,p), 1/p, dtype=MtY.dtype)
+    support = xp.ones((ns,p), dtype=bool)
+    todo = xp.arange(ns)
+
+    for _ in range(maxiter):
+        G = MtM[todo]
+        b = MtY[todo]
+        s = support[todo]
+        a = out[todo]
+        rows = xp.arange(len(todo))
+
+        # [G_s 1_s; 1_s' 0] [x; mu] = [b_s; 1], with x = 0 off the support
+        K = xp.zeros((len(todo),p+1,p+1), dtype=MtY.dtype)
+        K[:,:p,:p] = where(s[:,:,None] & s[:,None,:], G, 0) + xp.eye(p, dtype=MtY.dtype)*~s[:,None,:]
+        K[:,:p,p] = s
+        K[:,p,:p] = s
+        rhs = xp.zeros((len(todo),p+1), dtype=MtY.dtype)
+        rhs[:,:p] = b*s
+        rhs[:,p] = 1
+        X = linalg.solve(K, rhs[:,:,None])[:,:,0]
+        x = X[:,:p]
+
+        # infeasible: move from a towards x until the first abundance hits 0
+        neg = s & (x < 0)
+        infeasible = neg.any(axis=1)
+        ratio = where(neg, a/where(neg, a - x, 1), xp.inf)
+        k = ratio.argmin(axis=1)
+        alpha = where(infeasible, ratio[rows,k], 0)[:,None]
+        a_step = a + alpha*(x - a)
+        a_step[rows[infeasible], k[infeasible]] = 0
+        s[rows[infeasible], k[infeasible]] = False
+
+        # feasible: free the endmember with the most negative multiplier
+        lam = where(s, xp.inf, einsum('kpq,kq->kp', G, x) - b + X[:,p:])
+        j = lam.argmin(axis=1)
+        add = ~infeasible & (lam[rows,j] < -1e-10)
+        s[rows[add], j[add]] = True
+
+        out[todo] = where(infeasible[:,None], a_step, x)
+        support[todo] = s
+        todo = todo[infeasible | add]
+        if len(todo) == 0:
+            break
+    else:
+        warnings.warn(f'FCLSU: {len(todo)} pixels did not converge in {maxiter} active set iterations', RuntimeWarning)
 
-    for i in range(ns):
-        s[0:l] = Delta*HIM[:,i,None] 
-        s[l] = 1
-        Abundances = nnls(N,s.flatten())[0].T
-        out[i,:] = Abundances
     return out
 
+# numpy for CPU arrays, cupy for GPU arrays
+def get_array_module(*args):
+    if cupy is None:
+        return numpy
+    return cupy.get_array_module(*args)
+
+# forward and inverse real FFT over the image axes of an m*n(*P) array
+# (cuFFT plans are cached by cupy, pocketfft plans by scipy)
+def rfft_im(X):
+    if get_array_module(X) is numpy:
+        return rfftn(X, axes=(0,1), workers=-1)
+    return cupy_fft.rfftn(X, axes=(0,1))
+
+def irfft_im(F, m, n):
+    if get_array_module(F) is numpy:
+        return irfftn(F, s=(m,n), axes=(0,1), workers=-1, overwrite_x=True)
+    return cupy_fft.irfftn(F, s=(m,n), axes=(0,1), overwrite_x=True)
+
+# min w.r.t. A and mu of the ADMM loop
+# for each pixel k, solves the KKT system of the sum-to-one constrained
+# problem: [S_k'S_k + 2*rho*I 1; 1' 0] [a_k; mu_k] = [S_k'y_k + rho*(v1+d1+v4+d4)_k; 1]
+# StS: N*P*P stacked Gram matrices, Std: N*P stacked S_k'y_k
+def admm_kkt_solve(StS, Std, v1, d1, v4, d4, rho):
+    if get_array_module(StS) is numpy:
+        return admm_kkt_solve_cpu(StS, Std, v1, d1, v4, d4, rho)
+    return admm_kkt_solve_xp(StS, Std, v1, d1, v4, d4, rho)
+
+# array expressions for any array module (used for GPU arrays), as a single
+# batched solve
+def admm_kkt_solve_xp(StS, Std, v1, d1, v4, d4, rho):
+    xp = get_array_module(StS)
+    N, P, _ = StS.shape
+    K = xp.zeros((N,P+1,P+1), dtype=StS.dtype)
+    K[:,:P,:P] = StS + 2*rho*xp.eye(P, dtype=StS.dtype)
+    K[:,:P,P] = 1
+    K[:,P,:P] = 1
+    b = xp.empty((N,P+1), dtype=StS.dtype)
+    b[:,:P] = Std + rho*(v1 + d1 + v4 + d4).T
+    b[:,P] = 1
+    X = xp.linalg.solve(K, b[:,:,None])[...,0]
+    return X[:,:P].T, X[:,P]
+
+@njit(cache=True, fastmath=True, parallel=True)
+def admm_kkt_solve_cpu(StS, Std, v1, d1, v4, d4, rho):
+    N, P, _ = StS.shape
+    A = empty((P,N), dtype=StS.dtype)
+    mu = empty(N, dtype=StS.dtype)
+    for k in prange(N):
+        K = zeros((P+1,P+1), dtype=StS.dtype)
+        b = empty(P+1, dtype=StS.dtype)
+        for p in range(P):
+            for q in range(P):
+                K[p,q] = StS[k,p,q]
+            K[p,p] += 2*rho
+            K[p,P] = 1
+            K[P,p] = 1
+            b[p] = Std[k,p] + rho*(v1[p,k] + d1[p,k] + v4[p,k] + d4[p,k])
+        b[P] = 1
+        x = linalg.solve(K, b)
+        A[:,k] = x[:P]
+        mu[k] = x[P]
+    return A, mu
+
+# min w.r.t. v4 and dual update of the ADMM loop
+# updates d1..d4 in place and returns v4 with the squared norms of the four
+# primal residuals and of the v1 and v4 increments
+def admm_dual_update(A, v1, v1_old, v2, v3, v4_old, d1, d2, d3, d4, Hhv1, Hvv1):
+    if get_array_module(A) is numpy:
+        return admm_dual_update_cpu(A, v1, v1_old, v2, v3, v4_old, d1, d2, d3, d4, Hhv1, Hvv1)
+    return admm_dual_update_xp(A, v1, v1_old, v2, v3, v4_old, d1, d2, d3, d4, Hhv1, Hvv1)
+
+# array expressions for any array module (used for GPU arrays)
+def admm_dual_update_xp(A, v1, v1_old, v2, v3, v4_old, d1, d2, d3, d4, Hhv1, Hvv1):
+    xp = get_array_module(A)
+    v4 = xp.maximum(A - d4, 0)
+    p_res = (v1 - A, v2 - Hhv1, v3 - Hvv1, v4 - A)
+    for d, r in zip((d1, d2, d3, d4), p_res):
+        d += r
+    n1, n2, n3, n4 = (xp.vdot(r, r) for r in p_res)
+    dv1 = v1 - v1_old
+    dv4 = v4 - v4_old
+    return v4, n1, n2, n3, n4, xp.vdot(dv1, dv1), xp.vdot(dv4, dv4)
+
+@njit(cache=True, fastmath=True, parallel=True)
+def admm_dual_update_cpu(A, v1, v1_old, v2, v3, v4_old, d1, d2, d3, d4, Hhv1, Hvv1):
+    P, N = A.shape
+    v4 = empty((P,N), dtype=A.dtype)
+    n1 = n2 = n3 = n4 = ndv1 = ndv4 = 0.0
+    for idx in prange(P*N):
+        p = idx // N
+        k = idx % N
+        v4_pk = A[p,k] - d4[p,k]
+        if v4_pk < 0:
+            v4_pk = 0.0
+        v4[p,k] = v4_pk
+
+        r1 = v1[p,k] - A[p,k]
+        r2 = v2[p,k] - Hhv1[p,k]
+        r3 = v3[p,k] - Hvv1[p,k]
+        r4 = v4_pk - A[p,k]
+        d1[p,k] += r1
+        d2[p,k] += r2
+        d3[p,k] += r3
+        d4[p,k] += r4
+        n1 += r1*r1
+        n2 += r2*r2
+        n3 += r3*r3
+        n4 += r4*r4
+
+        e1 = v1[p,k] - v1_old[p,k]
+        e4 = v4_pk - v4_old[p,k]
+        ndv1 += e1*e1
+        ndv4 += e4*e4
+    return v4, n1, n2, n3, n4, ndv1, ndv4
+
 # circular convolution
 def ConvC(X, FK, m, n, P):
     # matlab:
     # reshape(real(ifft2(fft2(reshape(X', m,n,P)).*repmat(FK,[1,1,P])) ), m*n,P)';
 
-    # AN ESPECIALLY WEIRD m->py DISCREPANCY
-    # not exactly sure how this works, but it's what I've been using.
-    # MATLAB: S = repmat(S0,[1,1,N]);
-    # python: S = array([tile(S0,(1,1)) for i in range(N)]).T
-    
-    first_op = fft.fft2(X.T.reshape(m,n,P, order='F'))
-    second_op = real( fft.ifft2( first_op * array([tile(S0,(1,1)) for i in range(P)]).T))
-    third_op = second_op.reshape( m*n, P ).T
+    # X is real, so only the half spectrum is needed: FK is the kernel's
+    # rfft2, i.e. its fft2 restricted to the first n//2+1 columns (as are
+    # FDh and FDv).
+    # The kernel is broadcast over the P planes instead of being repmat'ed.
+    Xi = X.T.reshape((m,n,P), order='F')
+    Y = irfft_im(rfft_im(Xi) * FK[:,:,None], m, n)
 
-    return third_op
+    return Y.reshape((m*n,P), order='F').T
 
 # convert matrix to image
+# (column-major, as MATLAB's reshape(A',m,n,P))
 def conv2im(A, m, n, P):
-    return A.T.reshape((m,n,P))
+    return A.T.reshape((m,n,P), order='F')
 
 # convert image to matrix
+# (column-major, as MATLAB's reshape(A,m*n,P)')
 def conv2mat(A, m, n, P):
-    return A.reshape((m*n,P)).T
+    return A.reshape((m*n,P), order='F').T
 
 # # soft(x,T) and vector_soft_col(X, tau) are in a separate .m file in source code
 
 # soft-thresholding function
+# x is thresholded elementwise by T, which is either a one element array or
+# has the same number of elements as x (T = 0 leaves x unchanged)
 def soft(x, T):
-    if sum(abs(T.flatten(1))) == 0:
-        y = x
-    else:
-        y = max(abs(x)-T, 0)
-        y = y/(y+T) * x
-    return y
+    if get_array_module(x) is numpy:
+        return soft_cpu(x, T)
+    return soft_xp(x, T)
+
+# array expressions for any array module (used for GPU arrays)
+def soft_xp(x, T):
+    xp = get_array_module(x)
+    T = T.reshape(-1) if T.size == 1 else T.reshape(x.shape)
+    return xp.sign(x) * xp.maximum(xp.abs(x) - T, 0)
+
+@njit(cache=True, fastmath=True, parallel=True)
+def soft_cpu(x, T):
+    xf = x.ravel()
+    Tf = T.ravel()
+    out = empty_like(xf)
+    for i in prange(xf.size):
+        v = abs(xf[i]) - Tf[i % Tf.size]
+        out[i] = 0.0 if v <= 0 else sign(xf[i])*v
+    return out.reshape(x.shape)
 
 # computes the vector soft columnwise
+# (a 1-D X is shrunk as a whole by its 2-norm, as MATLAB's sum reduces a
+# row vector to a scalar)
 def vector_soft_col(X, tau):
-    NU = math.sqrt(sum(X**2))
-    A = max(0,NU-tau)
-    Y = kron(ones((size(X, axis=1),1)), (A/(A+tau))) * X
-    return Y
+    NU = linalg.norm(X, axis=0)
+    scale = maximum(0, NU-tau) / maximum(NU, 1e-12)
+    Y = X * scale
+    return Y.reshape(X.shape)
+
+# min w.r.t. v2 and v3 of the ADMM loop, one function per lambda_a shape and
+# norm_sr: v2 and v3 are the shrinkages of Hh*v1 - d2 and Hv*v1 - d3
+# scalar lambda_a, l1,1 norm
+def admm_scalar_11(d2, d3, Hhv1, Hvv1, lambda_a, rho):
+    T = lambda_a/rho
+    return soft(Hhv1 - d2, T), soft(Hvv1 - d3, T)
+
+# scalar lambda_a, l2,1 norm
+def admm_scalar_21(d2, d3, Hhv1, Hvv1, lambda_a, rho):
+    tau = lambda_a/rho
+    return vector_soft_col(Hhv1 - d2, tau), vector_soft_col(Hvv1 - d3, tau)
+
+# P*1 lambda_a, l1,1 norm: row p is thresholded by lambda_a[p]/rho
+def admm_vec_11(d2, d3, Hhv1, Hvv1, lambda_a, rho):
+    T = broadcast_to(lambda_a/rho, Hhv1.shape)
+    return soft(Hhv1 - d2, T), soft(Hvv1 - d3, T)
+
+# P*1 lambda_a, l2,1 norm: as vector_soft_col on each 1*N row, row p is
+# shrunk as a whole by its 2-norm, with the threshold lambda_a[p]/rho
+def admm_vec_21(d2, d3, Hhv1, Hvv1, lambda_a, rho):
+    tau = lambda_a/rho
+    X2 = Hhv1 - d2
+    X3 = Hvv1 - d3
+    nu2 = linalg.norm(X2, axis=1, keepdims=True)
+    nu3 = linalg.norm(X3, axis=1, keepdims=True)
+    return X2 * (maximum(0, nu2-tau) / maximum(nu2, 1e-12)), X3 * (maximum(0, nu3-tau) / maximum(nu3, 1e-12))
 
 '''
 # code block used for testing by running this .py file
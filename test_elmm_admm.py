@@ -0,0 +1,382 @@
+import warnings
+
+import numpy as np
+import pytest
+from scipy.optimize import nnls
+
+from elmm_admm import (elmm_admm, FCLSU, admm_vec_11, admm_vec_21, admm_kkt_solve_cpu,
+                       admm_kkt_solve_xp, admm_dual_update_cpu,
+                       admm_dual_update_xp, soft_cpu, soft_xp)
+
+
+# per-pixel lsqnonneg on the Delta-augmented system, as in toolbox/FCLSU.m
+def fclsu_nnls(HIM, M, Delta=1/1000):
+    l, ns = HIM.shape
+    out = np.zeros((ns, M.shape[-1]))
+    for i in range(ns):
+        Mi = M if M.ndim == 2 else M[i]
+        N = np.vstack([Delta*Mi, np.ones((1, Mi.shape[1]))])
+        s = np.append(Delta*HIM[:,i], 1)
+        out[i] = nnls(N, s)[0]
+    return out
+
+
+@pytest.mark.parametrize('p', [3, 6, 15])
+@pytest.mark.parametrize('per_pixel', [False, True])
+def test_fclsu_matches_nnls(p, per_pixel):
+    rng = np.random.default_rng(p)
+    l, ns = 40, 200
+    if per_pixel:
+        M = np.abs(rng.standard_normal((ns, l, p))) + 0.1
+        Y = np.einsum('klp,pk->lk', M, rng.dirichlet(np.ones(p), ns).T)
+    else:
+        M = np.abs(rng.standard_normal((l, p))) + 0.1
+        Y = M @ rng.dirichlet(np.ones(p), ns).T
+    # noise pushes some abundances onto the boundary of the simplex
+    Y = Y + 0.05*rng.standard_normal(Y.shape)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        out = FCLSU(Y, M)
+
+    np.testing.assert_allclose(out, fclsu_nnls(Y, M), atol=1e-5)
+    assert (out >= 0).all()
+    np.testing.assert_allclose(out.sum(axis=1), 1, atol=1e-10)
+
+
+def test_fclsu_warns_when_not_converged():
+    rng = np.random.default_rng(0)
+    M = np.abs(rng.standard_normal((40, 8))) + 0.1
+    Y = M @ rng.dirichlet(0.1*np.ones(8), 50).T + 0.05*rng.standard_normal((40, 50))
+    with pytest.warns(RuntimeWarning, match='did not converge'):
+        FCLSU(Y, M, maxiter=1)
+
+
+# soft.m and vector_soft_col.m (sum reduces the columns of a matrix and
+# the whole of a row vector)
+def soft_m(x, T):
+    return np.sign(x) * np.maximum(np.abs(x) - T, 0)
+
+
+def vector_soft_col_m(X, tau):
+    nu = np.sqrt(np.sum(X**2, axis=0))
+    a = np.maximum(0, nu - tau)
+    return a/(a + tau) * X
+
+
+# min w.r.t. v2 and v3 with a per-endmember lambda_a, looping over the rows
+# as ELMM_ADMM.m does, with vector_soft_col.m on each 1*N row
+def shrink_vec_loop(d2, d3, Hhv1, Hvv1, lambda_a, rho, norm_sr):
+    shrink = vector_soft_col_m if norm_sr == '2,1' else soft_m
+    v2 = np.zeros_like(d2)
+    v3 = np.zeros_like(d3)
+    for p in range(d2.shape[0]):
+        v2[p,:] = shrink(-(d2[p,:] - Hhv1[p,:]), lambda_a[p,0]/rho)
+        v3[p,:] = shrink(-(d3[p,:] - Hvv1[p,:]), lambda_a[p,0]/rho)
+    return v2, v3
+
+
+@pytest.mark.parametrize('norm_sr', ['1,1', '2,1'])
+def test_admm_vec_shrink_matches_loop(norm_sr):
+    rng = np.random.default_rng(1)
+    P, N = 4, 50
+    d2, d3, Hhv1, Hvv1 = rng.standard_normal((4, P, N))
+    # the last row is shrunk to zero by the l2,1 step
+    lambda_a = np.array([[0.1], [1.0], [3.0], [100.0]])
+    rho = 2.0
+
+    shrink = admm_vec_21 if norm_sr == '2,1' else admm_vec_11
+    v2, v3 = shrink(d2, d3, Hhv1, Hvv1, lambda_a, rho)
+    v2_ref, v3_ref = shrink_vec_loop(d2, d3, Hhv1, Hvv1, lambda_a, rho, norm_sr)
+
+    np.testing.assert_allclose(v2, v2_ref, atol=1e-12)
+    np.testing.assert_allclose(v3, v3_ref, atol=1e-12)
+
+
+# the array expression paths taken by cupy arrays, run on numpy arrays
+# against the numba kernels
+def admm_state(P=4, N=60, seed=2):
+    rng = np.random.default_rng(seed)
+    S = np.abs(rng.standard_normal((N, 20, P)))
+    StS = S.transpose(0,2,1) @ S
+    Std = rng.standard_normal((N, P))
+    return StS, Std, rng.standard_normal((11, P, N))
+
+
+def test_admm_kkt_solve_xp_matches_cpu():
+    StS, Std, V = admm_state()
+    v1, d1, v4, d4 = V[:4]
+    A, mu = admm_kkt_solve_cpu(StS, Std, v1, d1, v4, d4, 2.5)
+    A_xp, mu_xp = admm_kkt_solve_xp(StS, Std, v1, d1, v4, d4, 2.5)
+    np.testing.assert_allclose(A, A_xp, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(mu, mu_xp, rtol=1e-10, atol=1e-12)
+
+
+def test_admm_dual_update_xp_matches_cpu():
+    A, v1, v1_old, v2, v3, v4_old, d1, d2, d3, d4, Hhv1 = admm_state()[2]
+    Hvv1 = -Hhv1
+    d = (d1, d2, d3, d4)
+    d_cpu = [x.copy() for x in d]
+    d_xp = [x.copy() for x in d]
+    out = admm_dual_update_cpu(A, v1, v1_old, v2, v3, v4_old, *d_cpu, Hhv1, Hvv1)
+    out_xp = admm_dual_update_xp(A, v1, v1_old, v2, v3, v4_old, *d_xp, Hhv1, Hvv1)
+    for x, y in zip(out, out_xp):
+        np.testing.assert_allclose(x, y, rtol=1e-10)
+    for x, y in zip(d_cpu, d_xp):
+        np.testing.assert_allclose(x, y, rtol=1e-12)
+
+
+@pytest.mark.parametrize('shape', [(), (4, 60)])
+def test_soft_xp_matches_cpu(shape):
+    x = admm_state()[2][0]
+    T = np.abs(np.random.default_rng(3).standard_normal(shape)).reshape(shape or (1, 1))
+    np.testing.assert_allclose(soft_cpu(x, T), soft_xp(x, T), rtol=1e-12)
+
+
+# straightforward translation of ELMM_ADMM.m: pixel loops, full fft2 and
+# MATLAB's column-major reshapes (S is kept L*P*N, as in MATLAB)
+def elmm_admm_m(data, A_init, psis_init, S0, lambda_s, lambda_a, lambda_psi,
+                norm_sr, maxiter_anls, maxiter_admm, epsilon_s=1e-3,
+                epsilon_a=1e-3, epsilon_psi=1e-3, epsilon_admm_abs=1e-2,
+                epsilon_admm_rel=1e-2):
+    m, n, L = data.shape
+    P = S0.shape[1]
+    N = m*n
+    lambda_a = np.ravel(lambda_a)
+    lambda_psi = np.ravel(lambda_psi)
+    scalar_lambda_a = lambda_a.size == 1
+    scalar_lambda_psi = lambda_psi.size == 1
+
+    data_r = data.reshape((N, L), order='F').T
+    A = A_init.copy()
+    S = np.repeat(S0[:,:,None], N, axis=2)
+    psi_maps = psis_init.copy()
+    S0ptS0 = np.diag(S0.T @ S0)
+
+    objective = np.zeros(maxiter_anls)
+    TV_a = np.zeros((maxiter_anls, lambda_a.size))
+    smooth_psi = np.zeros((maxiter_anls, lambda_psi.size))
+    primal_all = np.zeros((maxiter_anls, maxiter_admm))
+    dual_all = np.zeros((maxiter_anls, maxiter_admm))
+
+    FDh = np.zeros((m, n))
+    FDh[-1,0] = -1
+    FDh[-1,-1] = 1
+    FDh = np.fft.fft2(FDh)
+    FDv = np.zeros((m, n))
+    FDv[0,-1] = -1
+    FDv[-1,-1] = 1
+    FDv = np.fft.fft2(FDv)
+    denom = np.ones((m, n)) + np.abs(FDh)**2 + np.abs(FDv)**2
+
+    rho = np.zeros(maxiter_admm)
+    rho[0] = 10
+
+    def ConvC(X, FK):
+        Xi = X.T.reshape((m,n,P), order='F')
+        Y = np.real(np.fft.ifft2(np.fft.fft2(Xi, axes=(0,1)) * FK[:,:,None], axes=(0,1)))
+        return Y.reshape((N,P), order='F').T
+
+    def conv2im(X):
+        return X.T.reshape((m,n,P), order='F')
+
+    def conv2mat(X):
+        return X.reshape((N,P), order='F').T
+
+    fro2 = lambda X: np.linalg.norm(X)**2
+
+    for i in range(maxiter_anls):
+        S_old = S.copy()
+        psi_maps_old = psi_maps.copy()
+        A_old_anls = A.copy()
+
+        for k in range(N):
+            num = np.outer(data_r[:,k], A[:,k]) + lambda_s*S0 @ np.diag(psi_maps[:,k])
+            den = np.outer(A[:,k], A[:,k]) + lambda_s*np.eye(P)
+            S[:,:,k] = np.maximum(1e-6, num @ np.linalg.inv(den))
+
+        if lambda_a.any():
+            v1 = A.copy()
+            v2 = ConvC(A, FDh)
+            v3 = ConvC(A, FDv)
+            v4 = A.copy()
+            d1 = np.zeros((P, N))
+            d2 = np.zeros(v2.shape)
+            d3 = np.zeros(v3.shape)
+            d4 = np.zeros(psi_maps.shape)
+            primal = primal_all[i]
+            dual = dual_all[i]
+            Hvv1 = ConvC(v1, FDv)
+            Hhv1 = ConvC(v1, FDh)
+
+            for it in range(maxiter_admm):
+                v1_old = v1
+                p_res2_old = v2 - Hhv1
+                p_res3_old = v3 - Hvv1
+                v4_old = v4
+                d1_old = d1
+                d4_old = d4
+
+                A = A.copy()
+                for k in range(N):
+                    Sk = S[:,:,k]
+                    ALPHA_INVERTED = np.linalg.inv(Sk.T @ Sk + 2*rho[it]*np.eye(P))
+                    BETA = np.ones((P, 1))
+                    s = ALPHA_INVERTED.sum()
+                    SEC_MEMBER = np.append(Sk.T @ data_r[:,k] + rho[it]*(v1[:,k] + d1[:,k] + v4[:,k] + d4[:,k]), 1)
+                    OMEGA_INV = np.block([[ALPHA_INVERTED @ (np.eye(P) - 1/s*np.ones((P,P)) @ ALPHA_INVERTED), 1/s*ALPHA_INVERTED @ BETA],
+                                          [1/s*BETA.T @ ALPHA_INVERTED, -1/s*np.ones((1,1))]])
+                    A[:,k] = (OMEGA_INV @ SEC_MEMBER)[:P]
+
+                A_im = conv2im(A)
+                d1_im = conv2im(d1)
+                d2_im = conv2im(d2)
+                d3_im = conv2im(d3)
+                v2_im = conv2im(v2)
+                v3_im = conv2im(v3)
+                v1_im = np.zeros((m, n, P))
+                for p in range(P):
+                    second = np.fft.fft2(A_im[:,:,p] - d1_im[:,:,p]) + np.fft.fft2(v2_im[:,:,p] + d2_im[:,:,p])*np.conj(FDh) + np.fft.fft2(v3_im[:,:,p] + d3_im[:,:,p])*np.conj(FDv)
+                    v1_im[:,:,p] = np.real(np.fft.ifft2(second/denom))
+                v1 = conv2mat(v1_im)
+                Hvv1 = ConvC(v1, FDv)
+                Hhv1 = ConvC(v1, FDh)
+
+                if scalar_lambda_a:
+                    shrink = vector_soft_col_m if norm_sr == '2,1' else soft_m
+                    v2 = shrink(-(d2 - Hhv1), lambda_a[0]/rho[it])
+                    v3 = shrink(-(d3 - Hvv1), lambda_a[0]/rho[it])
+                else:
+                    v2, v3 = shrink_vec_loop(d2, d3, Hhv1, Hvv1, lambda_a[:,None], rho[it], norm_sr)
+
+                v4 = np.maximum(A - d4, 0)
+
+                p_res1 = v1 - A
+                p_res2 = v2 - Hhv1
+                p_res3 = v3 - Hvv1
+                p_res4 = v4 - A
+                d1 = d1 + p_res1
+                d2 = d2 + p_res2
+                d3 = d3 + p_res3
+                d4 = d4 + p_res4
+
+                primal[it] = np.sqrt(fro2(p_res1) + fro2(p_res2) + fro2(p_res3) + fro2(p_res4))
+                dual[it] = rho[it]*np.sqrt(fro2(v1_old - v1) + fro2(v4_old - v4))
+                epsilon_primal = np.sqrt(4*P*N)*epsilon_admm_abs + epsilon_admm_rel*max(np.sqrt(2*fro2(A)),
+                    np.sqrt(fro2(v1_old) + fro2(p_res2_old) + fro2(p_res3_old) + fro2(v4_old)))
+                epsilon_dual = np.sqrt(P*N)*epsilon_admm_abs + rho[it]*epsilon_admm_rel*np.sqrt(np.linalg.norm(d1_old) + fro2(d4_old))
+
+                if it > 0 and primal[it] < epsilon_primal and dual[it] < epsilon_dual:
+                    break
+
+                if it < maxiter_admm - 1:
+                    if primal[it] > 10*dual[it]:
+                        rho[it+1] = 2*rho[it]
+                        A = A/2
+                    elif dual[it] > 10*primal[it]:
+                        rho[it+1] = rho[it]/2
+                        A = 2*A
+                    else:
+                        rho[it+1] = rho[it]
+        else:
+            for k in range(N):
+                A[:,k] = FCLSU(data_r[:,k], S[:,:,k])[0]
+
+        if lambda_psi.any():
+            for p in range(P):
+                lp = lambda_psi[0] if scalar_lambda_psi else lambda_psi[p]
+                numerator = (lambda_s*S[:,p,:].T @ S0[:,p]).reshape((m,n), order='F')
+                psi_maps_im = np.real(np.fft.ifft2(np.fft.fft2(numerator)/(lp*(np.abs(FDh)**2 + np.abs(FDv)**2) + lambda_s*S0ptS0[p])))
+                psi_maps[p,:] = psi_maps_im.ravel(order='F')
+        else:
+            for p in range(P):
+                for k in range(N):
+                    psi_maps[p,k] = S0[:,p] @ S[:,p,k]/S0ptS0[p]
+
+        rs = np.mean([np.linalg.norm(S[:,:,k] - S_old[:,:,k])/np.linalg.norm(S_old[:,:,k]) for k in range(N)])
+        ra = np.linalg.norm(A - A_old_anls)/np.linalg.norm(A_old_anls)
+        rpsi = np.linalg.norm(psi_maps - psi_maps_old)/np.linalg.norm(psi_maps_old)
+
+        SkAk = np.zeros((L, N))
+        S0_psi = np.zeros((L, P, N))
+        for k in range(N):
+            SkAk[:,k] = S[:,:,k] @ A[:,k]
+            S0_psi[:,:,k] = S0 @ np.diag(psi_maps[:,k])
+        objective[i] = 1/2*fro2(data_r - SkAk) + lambda_s*1/2*np.sum((S - S0_psi)**2)
+
+        if lambda_psi.any():
+            Ch, Cv = ConvC(psi_maps, FDh), ConvC(psi_maps, FDv)
+            if scalar_lambda_psi:
+                smooth_psi[i] = 1/2*(np.sum(Ch**2) + np.sum(Cv**2))
+            else:
+                smooth_psi[i] = 1/2*(np.sum(Ch**2, axis=1) + np.sum(Cv**2, axis=1))
+            objective[i] += lambda_psi @ smooth_psi[i]
+        if lambda_a.any():
+            Ch, Cv = ConvC(A, FDh), ConvC(A, FDv)
+            T = np.sqrt(Ch**2 + Cv**2) if norm_sr == '2,1' else np.abs(Ch) + np.abs(Cv)
+            TV_a[i] = T.sum() if scalar_lambda_a else T.sum(axis=1)
+            objective[i] += lambda_a @ TV_a[i]
+
+        if rs < epsilon_s and ra < epsilon_a and rpsi < epsilon_psi:
+            break
+
+    return A, psi_maps, S.transpose(2,0,1), objective, primal_all, dual_all
+
+
+# epsilon_admm = 0.05 lets ADMM stop at its second iteration
+@pytest.mark.parametrize('lambda_a, lambda_psi, norm_sr, epsilon_admm', [
+    (0, 0, '1,1', 1e-2),
+    (0, 0.5, '1,1', 1e-2),
+    (0.05, 0, '1,1', 1e-2),
+    (0.05, 0.5, '1,1', 1e-2),
+    (0.05, 0.5, '1,1', 0.05),
+    (0.05, 0.5, '2,1', 1e-2),
+    ([0.02, 0.05, 0.1], [0.2, 0.5, 1.0], '1,1', 1e-2),
+    ([0.02, 0.05, 0.1], [0.2, 0.5, 1.0], '2,1', 1e-2),
+])
+def test_elmm_admm_matches_matlab_loops(lambda_a, lambda_psi, norm_sr, epsilon_admm):
+    rng = np.random.default_rng(4)
+    # m != n so that a transposed pixel order does not go unnoticed
+    m, n, L, P = 6, 5, 12, 3
+    N = m*n
+    S0 = np.abs(rng.standard_normal((L, P))) + 0.2
+    A_true = rng.dirichlet(np.ones(P), N).T
+    psi_true = 1 + 0.1*rng.standard_normal((P, N))
+    data_r = S0 @ (A_true*psi_true) + 0.01*rng.standard_normal((L, N))
+    data = data_r.T.reshape((m, n, L), order='F')
+    A_init = FCLSU(data_r, S0).T
+    psis_init = np.ones((P, N))
+
+    A, psi_maps, S, optim_struct = elmm_admm(data, A_init, psis_init, S0, 0.5, lambda_a, lambda_psi,
+                                             norm_sr=norm_sr, verbose=False, maxiter_anls=3,
+                                             maxiter_admm=15, epsilon_admm_abs=epsilon_admm,
+                                             epsilon_admm_rel=epsilon_admm, dtype=np.float64)
+    A_m, psi_m, S_m, obj_m, primal_m, dual_m = elmm_admm_m(data, A_init, psis_init, S0, 0.5, lambda_a,
+                                                           lambda_psi, norm_sr, 3, 15,
+                                                           epsilon_admm_abs=epsilon_admm,
+                                                           epsilon_admm_rel=epsilon_admm)
+
+    np.testing.assert_allclose(A, A_m, atol=1e-10)
+    np.testing.assert_allclose(psi_maps, psi_m, atol=1e-10)
+    np.testing.assert_allclose(S, S_m, atol=1e-10)
+    np.testing.assert_allclose(optim_struct['obj'].ravel(), obj_m, rtol=1e-10)
+    np.testing.assert_allclose(optim_struct['primal'], primal_m, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(optim_struct['dual'], dual_m, rtol=1e-10, atol=1e-12)
+
+
+# the batched solve of the GPU path, written out for the stacked KKT systems
+def test_admm_kkt_solve_cpu_matches_batched_solve():
+    StS, Std, V = admm_state()
+    v1, d1, v4, d4 = V[:4]
+    N, P, _ = StS.shape
+    rho = 2.5
+    K = np.zeros((N, P+1, P+1))
+    K[:,:P,:P] = StS + 2*rho*np.eye(P)
+    K[:,:P,P] = 1
+    K[:,P,:P] = 1
+    b = np.concatenate([Std + rho*(v1 + d1 + v4 + d4).T, np.ones((N, 1))], axis=1)
+    X = np.linalg.solve(K, b[:,:,None])[...,0]
+
+    A, mu = admm_kkt_solve_cpu(StS, Std, v1, d1, v4, d4, rho)
+    np.testing.assert_allclose(A, X[:,:P].T, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(mu, X[:,P], rtol=1e-10, atol=1e-12)